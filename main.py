@@ -1,14 +1,14 @@
 import asyncio
-import html
-import json
 import logging
+import math
 import re
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta, UTC
+import time
+from datetime import datetime
 from decimal import Decimal, getcontext, InvalidOperation
 from pathlib import Path
 
 import aiohttp
+import orjson
 from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, CommandStart
@@ -33,11 +33,20 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 # --- Файл для хранения статистики ---
 STATS_FILE = Path("bot_stats.json")
+STATS_FLUSH_INTERVAL = 30  # секунд между сохранениями статистики на диск
+USER_RETENTION = 30 * 86400  # пользователи, не заходившие дольше, удаляются из статистики
+USER_EVICTION_INTERVAL = 3600  # секунд между чистками неактивных пользователей
 
 # --- API Endpoints & URLs ---
 CBR_API_URL = "https://www.cbr.ru/scripts/XML_daily.asp"  # API Центробанка РФ
 BINANCE_API_URL = "https://api.binance.com/api/v3/ticker/price?symbol={}"
 
+# --- Параметры HTTP-запросов ---
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=5, connect=2)
+FETCH_ATTEMPTS = 2  # сколько раз пробовать запрос к внешнему API
+FETCH_RETRY_DELAY = 0.25  # секунд между попытками
+FETCH_FAILURE_BACKOFF = 15  # секунд без новых запросов к источнику после неудачного обновления
+
 # --- Словарь для сокращений ---
 TICKER_MAP = {
     # Для CBR, эти ключи будут сопоставлены с CharCode в XML
@@ -49,100 +58,358 @@ TICKER_MAP = {
     "bnc": "BTCUSDT",
     "eth": "ETHUSDT",
 }
+# Все тикеры, которые можно использовать в выражении, включая производные
+TICKERS = (*TICKER_MAP, "eu", "ob", "oe")
+
+# --- Регулярные выражения (компилируются один раз при импорте) ---
+# Длинные тикеры идут первыми, чтобы альтернатива не срабатывала на их префиксах
+_TICKER_RE = re.compile(r'\b(' + '|'.join(sorted(TICKERS, key=len, reverse=True)) + r')\b')
+# Токены калькулятора: "+X%"/"-X%", число, оператор или скобка
+_TOKEN_RE = re.compile(
+    r'\s*(?:(?P<pct_sign>[+-])\s*(?P<pct>\d+\.?\d*|\.\d+)\s*%'
+    r'|(?P<num>(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)'
+    r'|(?P<op>\*\*|//|[-+*/()]))'
+)
+# Все символы, которые может содержать выражение после подстановки курсов (e - экспонента числа;
+# запрос приводится к нижнему регистру, а repr(float) не дает заглавную E)
+_EXPRESSION_CHARS = ' 0123456789.+-*/()%e'
+_DROP_EXPRESSION_CHARS = str.maketrans('', '', _EXPRESSION_CHARS)
+# Каждый уровень скобок стоит парсеру нескольких кадров стека; глубже - ошибка синтаксиса
+_MAX_PAREN_DEPTH = 100
+# Блок <Valute> из XML ЦБ для нужных валют: CharCode, Nominal и Value
+_CBR_VALUTE_RE = re.compile(
+    r'<Valute[^>]*>\s*<NumCode>[^<]*</NumCode>\s*<CharCode>(USD|CNY|EUR)</CharCode>'
+    r'\s*<Nominal>(\d+)</Nominal>\s*<Name>[^<]*</Name>\s*<Value>([\d,]+)</Value>'
+)
+
+# --- Кэш курсов ---
+# ЦБ публикует курсы раз в сутки, Binance меняется постоянно, поэтому TTL разный.
+# Старше *_TTL значение считается устаревшим и обновляется в фоне, но продолжает отдаваться
+# пользователям, пока не станет старше *_MAX_AGE.
+CBR_CACHE_TTL = 900  # секунд
+CBR_CACHE_MAX_AGE = 86400  # секунд
+BINANCE_CACHE_TTL = 60  # секунд
+BINANCE_CACHE_MAX_AGE = 600  # секунд
+
+# failed_ts - время последнего неудачного обновления источника (None, если оно удалось)
+_cbr_cache = {"data": None, "ts": 0.0, "failed_ts": None}
+_binance_cache: dict[str, dict] = {  # тикер Binance -> {"data": ..., "ts": ..., "failed_ts": ...}
+    TICKER_MAP['bnc']: {"data": None, "ts": 0.0, "failed_ts": None},
+    TICKER_MAP['eth']: {"data": None, "ts": 0.0, "failed_ts": None},
+}
+# Единственное выполняющееся обновление курсов (single-flight): все, кому нужны свежие
+# данные, ждут эту задачу, а не запускают свои запросы к API
+_refresh_inflight: asyncio.Task | None = None
+# Итоговый словарь курсов (с производными) и его строковое представление для подстановки.
+# Пересобираются только когда меняется хотя бы один исходный курс.
+_all_prices_cache = {"sources": None, "data": {}, "strs": {}}
+# Из каких источников (кэш, TTL) складывается каждый тикер
+_CBR_SOURCE = (_cbr_cache, CBR_CACHE_TTL)
+_BNC_SOURCE = (_binance_cache[TICKER_MAP['bnc']], BINANCE_CACHE_TTL)
+_ETH_SOURCE = (_binance_cache[TICKER_MAP['eth']], BINANCE_CACHE_TTL)
+_TICKER_SOURCES = {
+    "ur": (_CBR_SOURCE,),
+    "cr": (_CBR_SOURCE,),
+    "er": (_CBR_SOURCE,),
+    "eu": (_CBR_SOURCE,),
+    "bnc": (_BNC_SOURCE,),
+    "eth": (_ETH_SOURCE,),
+    "ob": (_BNC_SOURCE, _CBR_SOURCE),
+    "oe": (_ETH_SOURCE, _CBR_SOURCE),
+}
+
+# --- HTTP-сессия ---
+# Одна сессия на всё время работы бота: keep-alive и пул соединений к CBR и Binance
+SESSION: aiohttp.ClientSession | None = None
 
 
 # --- Управление статистикой ---
 
+_cached_day = -1
+_cached_day_key = ""
+
+
+def _day_key(now: int) -> str:
+    """Возвращает ключ дня 'ГГГГ-ММ-ДД' (UTC) для Unix-времени; strftime вызывается только при смене суток."""
+    global _cached_day, _cached_day_key
+    day = now // 86400
+    if day != _cached_day:
+        _cached_day = day
+        _cached_day_key = time.strftime('%Y-%m-%d', time.gmtime(day * 86400))
+    return _cached_day_key
+
+
 def load_stats() -> dict:
     if not STATS_FILE.exists():
-        return {"total_requests": 0, "daily_requests": {}, "users": {}}
+        return {"total_requests": 0, "daily_requests": {}, "daily_users": {}, "users": {}}
     try:
-        with open(STATS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
-        return {"total_requests": 0, "daily_requests": {}, "users": {}}
+        return _migrate_stats(orjson.loads(STATS_FILE.read_bytes()))
+    except ValueError as e:  # orjson.JSONDecodeError тоже подкласс ValueError
+        logging.warning(f"Файл статистики поврежден ({e}), статистика начинается заново")
+        return {"total_requests": 0, "daily_requests": {}, "daily_users": {}, "users": {}}
+    except IOError:
+        return {"total_requests": 0, "daily_requests": {}, "daily_users": {}, "users": {}}
 
 
-def save_stats(data: dict):
+def _migrate_stats(stats: dict) -> dict:
+    """
+    Переводит статистику старого формата (last_seen в ISO-строках) на Unix-время
+    и заполняет счетчик уникальных пользователей за сегодня.
+    Если структура файла не похожа на статистику, выбрасывает ValueError.
+    """
+    if not isinstance(stats, dict):
+        raise ValueError("ожидался JSON-объект")
+    for key in ('daily_requests', 'daily_users', 'users'):
+        if not isinstance(stats.setdefault(key, {}), dict):
+            raise ValueError(f"поле {key!r} должно быть объектом")
+    users = stats['users']
+    for user_id, last_seen in list(users.items()):
+        if isinstance(last_seen, str):
+            try:
+                users[user_id] = int(datetime.fromisoformat(last_seen).timestamp())
+            except ValueError:
+                logging.warning(f"Некорректное время для пользователя {user_id}: {last_seen!r}, запись удалена")
+                del users[user_id]
+        elif not isinstance(last_seen, (int, float)):
+            logging.warning(f"Некорректное время для пользователя {user_id}: {last_seen!r}, запись удалена")
+            del users[user_id]
+    if not stats['daily_users']:
+        now = int(time.time())
+        day_start = now - now % 86400
+        stats['daily_users'] = {_day_key(now): sum(1 for ts in users.values() if ts >= day_start)}
+    return stats
+
+
+def save_stats(data: dict) -> bool:
+    """Сохраняет статистику в файл. Возвращает False, если записать не удалось."""
     try:
-        with open(STATS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        STATS_FILE.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        return True
     except IOError as e:
         logging.error(f"Не удалось сохранить статистику: {e}")
+        return False
+
+
+# Статистика живет в памяти и периодически сбрасывается на диск фоновой задачей
+STATS: dict = {}
+_stats_dirty = False
 
 
 async def update_stats(user_id: int):
-    """Обновляет статистику, используя современный метод получения времени в UTC."""
-    stats = load_stats()
-    today = datetime.now(UTC).strftime('%Y-%m-%d')
-    stats['total_requests'] = stats.get('total_requests', 0) + 1
-    daily_counts = stats.get('daily_requests', {})
+    """Обновляет статистику в памяти. Время хранится как Unix-время, дни считаются по UTC."""
+    global _stats_dirty
+    now = int(time.time())
+    today = _day_key(now)
+    STATS['total_requests'] = STATS.get('total_requests', 0) + 1
+    daily_counts = STATS.setdefault('daily_requests', {})
     daily_counts[today] = daily_counts.get(today, 0) + 1
-    stats['daily_requests'] = daily_counts
-    stats['users'][str(user_id)] = datetime.now(UTC).isoformat()
-    save_stats(stats)
+
+    # DAU считается инкрементально: пользователь учитывается при первом запросе за сутки (UTC)
+    users = STATS.setdefault('users', {})
+    user_key = str(user_id)
+    last_seen = users.get(user_key)
+    if last_seen is None or last_seen < now - now % 86400:
+        daily_users = STATS.setdefault('daily_users', {})
+        daily_users[today] = daily_users.get(today, 0) + 1
+    users[user_key] = now
+    _stats_dirty = True
+
+
+def evict_inactive_users() -> int:
+    """
+    Удаляет пользователей, не заходивших дольше USER_RETENTION.
+    После чистки размер STATS['users'] равен MAU. Возвращает число удаленных записей.
+    """
+    threshold = int(time.time()) - USER_RETENTION
+    users = STATS.get('users', {})
+    stale = [user_id for user_id, last_seen in users.items() if last_seen < threshold]
+    for user_id in stale:
+        del users[user_id]
+    return len(stale)
+
+
+async def flush_stats_periodically(stop: asyncio.Event):
+    """
+    Фоновая задача: раз в STATS_FLUSH_INTERVAL секунд сохраняет изменившуюся статистику.
+    Запись идет в отдельном потоке, чтобы не блокировать цикл событий. После установки stop
+    выполняет последнее сохранение и завершается.
+    """
+    global _stats_dirty
+    last_eviction = time.monotonic()
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), STATS_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        # Ошибка одной итерации не должна останавливать сохранение до конца работы бота
+        try:
+            if time.monotonic() - last_eviction >= USER_EVICTION_INTERVAL:
+                last_eviction = time.monotonic()
+                if evict_inactive_users():
+                    _stats_dirty = True
+            if _stats_dirty:
+                # Флаг сбрасывается до записи, чтобы не потерять изменения, сделанные во время нее;
+                # при неудаче он возвращается, и запись повторится на следующей итерации
+                _stats_dirty = False
+                if not await asyncio.to_thread(save_stats, STATS):
+                    _stats_dirty = True
+        except Exception:
+            _stats_dirty = True
+            logging.exception("Ошибка при сохранении статистики")
 
 
 # --- Логика получения данных ---
 
-async def fetch_cbr_prices(session: aiohttp.ClientSession) -> dict[str, Decimal]:
-    """Асинхронно получает и парсит курсы валют с API Центробанка РФ."""
+def _cache_get(cache: dict, ttl: float):
+    """Возвращает закэшированное значение, если оно ещё не устарело, иначе None."""
+    if cache["data"] is not None and time.monotonic() - cache["ts"] < ttl:
+        return cache["data"]
+    return None
+
+
+def _cache_put(cache: dict, data):
+    cache["data"] = data
+    cache["ts"] = time.monotonic()
+
+
+async def _get_with_retry(session: aiohttp.ClientSession, url: str, as_json: bool = False):
+    """GET-запрос, который повторяется при сетевой ошибке или таймауте. Возвращает текст или JSON."""
+    for attempt in range(1, FETCH_ATTEMPTS + 1):
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await response.json() if as_json else await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == FETCH_ATTEMPTS:
+                raise
+            logging.warning(f"Запрос к {url} не удался ({e!r}), повтор через {FETCH_RETRY_DELAY} с")
+            await asyncio.sleep(FETCH_RETRY_DELAY)
+
+
+async def fetch_cbr_prices(session: aiohttp.ClientSession) -> dict[str, float]:
+    """
+    Асинхронно получает и парсит курсы валют с API Центробанка РФ.
+    Ошибки запроса не перехватываются: их обрабатывает _refresh_prices.
+    """
+    cached = _cache_get(_cbr_cache, CBR_CACHE_TTL)
+    if cached is not None:
+        return cached
+
     prices = {}
-    try:
-        async with session.get(CBR_API_URL) as response:
-            response.raise_for_status()
-            text = await response.text()
-            root = ET.fromstring(text)
-
-            valute_map = {"USD": "ur", "CNY": "cr", "EUR": "er"}
-
-            for valute in root.findall('Valute'):
-                char_code = valute.find('CharCode').text
-                if char_code in valute_map:
-                    value_str = valute.find('Value').text.replace(',', '.')
-                    nominal = valute.find('Nominal').text
-                    price = Decimal(value_str) / Decimal(nominal)
-                    prices[valute_map[char_code]] = price
-        return prices
-    except Exception as e:
-        logging.error(f"Ошибка при получении данных с CBR API: {e}")
-        return {}
+    text = await _get_with_retry(session, CBR_API_URL)
+
+    valute_map = {"USD": "ur", "CNY": "cr", "EUR": "er"}
+
+    # Вместо построения полного дерева XML вытаскиваем только три нужных блока
+    for char_code, nominal, value_str in _CBR_VALUTE_RE.findall(text):
+        price = float(value_str.replace(',', '.')) / int(nominal)
+        prices[valute_map[char_code]] = price
+
+    if len(prices) == len(valute_map):
+        _cache_put(_cbr_cache, prices)
+    else:
+        logging.warning(
+            f"В ответе CBR найдены не все курсы ({', '.join(sorted(prices)) or 'ни одного'}), "
+            f"возможно, изменился формат XML"
+        )
+        # Неполный ответ сохраняем, только если другого нет, и сразу помечаем устаревшим,
+        # чтобы он был заменен при следующем обновлении
+        if prices and _cache_get(_cbr_cache, CBR_CACHE_MAX_AGE) is None:
+            _cache_put(_cbr_cache, prices)
+            _cbr_cache["ts"] -= CBR_CACHE_TTL
+    return prices
+
+
+async def get_binance_price(session: aiohttp.ClientSession, ticker: str) -> float:
+    """Получает цену с Binance. Ошибки запроса не перехватываются: их обрабатывает _refresh_prices."""
+    cache = _binance_cache.setdefault(ticker, {"data": None, "ts": 0.0, "failed_ts": None})
+    cached = _cache_get(cache, BINANCE_CACHE_TTL)
+    if cached is not None:
+        return cached
+
+    data = await _get_with_retry(session, BINANCE_API_URL.format(ticker), as_json=True)
+    price = float(data['price'])
+    _cache_put(cache, price)
+    return price
+
+
+def _source_due(cache: dict, ttl: float) -> bool:
+    """True, если значение источника старше TTL и источник не на паузе после неудачного обновления."""
+    if _cache_get(cache, ttl) is not None:
+        return False
+    failed_ts = cache["failed_ts"]
+    return failed_ts is None or time.monotonic() - failed_ts >= FETCH_FAILURE_BACKOFF
+
+
+async def _refresh_prices():
+    """
+    Параллельно обновляет устаревшие курсы. Источник, который не удалось обновить,
+    не запрашивается повторно в течение FETCH_FAILURE_BACKOFF секунд.
+    """
+    # Создаем задачи только для источников, которым пора обновиться
+    jobs = []
+    if _source_due(_cbr_cache, CBR_CACHE_TTL):
+        jobs.append(("CBR API", _cbr_cache, CBR_CACHE_TTL, fetch_cbr_prices(SESSION)))
+    for key in ('bnc', 'eth'):
+        ticker = TICKER_MAP[key]
+        cache = _binance_cache[ticker]
+        if _source_due(cache, BINANCE_CACHE_TTL):
+            jobs.append((f"Binance для {ticker}", cache, BINANCE_CACHE_TTL, get_binance_price(SESSION, ticker)))
+    if not jobs:
+        return
 
+    # Источники независимы: сбой одного не должен лишать курсов остальных
+    results = await asyncio.gather(*(job for *_, job in jobs), return_exceptions=True)
 
-async def get_binance_price(session: aiohttp.ClientSession, ticker: str) -> Decimal | None:
-    """Получает цену с Binance."""
-    try:
-        async with session.get(BINANCE_API_URL.format(ticker)) as response:
-            response.raise_for_status()
-            data = await response.json()
-            return Decimal(data['price'])
-    except Exception as e:
-        logging.error(f"Ошибка при получении данных с Binance для {ticker}: {e}")
-        return None
+    for (source, cache, ttl, _), result in zip(jobs, results):
+        if isinstance(result, Exception):
+            logging.error(f"Ошибка при получении данных с {source}: {result!r}")
+        # Неполный ответ тоже считается неудачей: кэш так и остался устаревшим
+        if isinstance(result, Exception) or _cache_get(cache, ttl) is None:
+            cache["failed_ts"] = time.monotonic()
+        else:
+            cache["failed_ts"] = None
 
 
-async def fetch_all_prices() -> dict[str, Decimal]:
+def _start_refresh() -> asyncio.Task:
     """
-    Асинхронно запрашивает все необходимые курсы с CBR и Binance.
+    Запускает обновление курсов, если оно еще не идет, и возвращает его задачу.
+    Проверка и запуск выполняются без await, поэтому в одном цикле событий они атомарны.
     """
-    all_prices = {}
-    async with aiohttp.ClientSession() as session:
-        # Создаем задачи для всех источников
-        cbr_task = fetch_cbr_prices(session)
-        bnc_task = get_binance_price(session, TICKER_MAP['bnc'])
-        eth_task = get_binance_price(session, TICKER_MAP['eth'])
+    global _refresh_inflight
+    if _refresh_inflight is None or _refresh_inflight.done():
+        _refresh_inflight = asyncio.create_task(_refresh_prices())
+    return _refresh_inflight
 
-        results = await asyncio.gather(cbr_task, bnc_task, eth_task)
 
-        # Обрабатываем результаты
-        cbr_prices, bnc_price, eth_price = results
+def _prices_need_refresh() -> bool:
+    """True, если хотя бы одному источнику пора обновиться (см. _source_due)."""
+    return (
+        _source_due(_cbr_cache, CBR_CACHE_TTL)
+        or any(_source_due(cache, BINANCE_CACHE_TTL) for cache in _binance_cache.values())
+    )
+
+
+def _combine_prices() -> dict[str, float]:
+    """
+    Собирает итоговый словарь курсов из кэша, пропуская значения старше *_MAX_AGE,
+    и вычисляет производные тикеры.
+    """
+    cbr_prices = _cache_get(_cbr_cache, CBR_CACHE_MAX_AGE)
+    bnc_price = _cache_get(_binance_cache[TICKER_MAP['bnc']], BINANCE_CACHE_MAX_AGE)
+    eth_price = _cache_get(_binance_cache[TICKER_MAP['eth']], BINANCE_CACHE_MAX_AGE)
+
+    sources = (cbr_prices, bnc_price, eth_price)
+    if sources == _all_prices_cache["sources"]:
+        return _all_prices_cache["data"]
 
-        if cbr_prices:
-            all_prices.update(cbr_prices)
-        if bnc_price:
-            all_prices['bnc'] = bnc_price
-        if eth_price:
-            all_prices['eth'] = eth_price
+    all_prices = {}
+    if cbr_prices:
+        all_prices.update(cbr_prices)
+    if bnc_price:
+        all_prices['bnc'] = bnc_price
+    if eth_price:
+        all_prices['eth'] = eth_price
 
     # Вычисляем производные тикеры
     if 'er' in all_prices and 'ur' in all_prices:
@@ -152,55 +419,222 @@ async def fetch_all_prices() -> dict[str, Decimal]:
     if 'eth' in all_prices and 'ur' in all_prices:
         all_prices['oe'] = all_prices['eth'] * all_prices['ur']
 
+    _all_prices_cache.update(
+        sources=sources,
+        data=all_prices,
+        strs={key: repr(value) for key, value in all_prices.items()},
+    )
     return all_prices
 
 
-# --- Логика вычислений (без изменений) ---
+async def fetch_all_prices(needed: set[str] = frozenset()) -> dict[str, float]:
+    """
+    Возвращает все курсы с CBR и Binance по схеме stale-while-revalidate:
+    устаревшие значения отдаются сразу, а их обновление запускается в фоне.
+    Ожидание сети происходит только когда какого-либо из тикеров needed нет в кэше
+    (холодный старт или, например, курс Binance старше BINANCE_CACHE_MAX_AGE) и его источнику
+    пора обновиться. Если источник на паузе после неудачи, ждать нечего: возвращаем что есть.
+    """
+    prices = _combine_prices()
+    if not _prices_need_refresh():
+        return prices
 
-async def evaluate_expression(expression: str) -> str:
-    original_expression = expression
-    try:
-        prices = await fetch_all_prices()
-        if not prices:
-            return "Ошибка: не удалось загрузить курсы."
+    refresh = _start_refresh()
+    missing = needed - prices.keys()
+    if any(
+        _source_due(cache, ttl)
+        for ticker in missing
+        for cache, ttl in _TICKER_SOURCES[ticker]
+    ):
+        # shield: отмена одного ожидающего запроса не должна прерывать общее обновление
+        await asyncio.shield(refresh)
+        return _combine_prices()
+    return prices
+
+
+def _price_strings() -> dict[str, str]:
+    """Строковые значения курсов, последний раз возвращенных fetch_all_prices, для подстановки."""
+    return _all_prices_cache["strs"]
 
-        for key in sorted(prices.keys(), key=len, reverse=True):
-            expression = re.sub(r'\b' + key + r'\b', str(prices[key]), expression)
 
-        expression = re.sub(r'(\(?\d[\d\.\s]*\)?)\s*\+\s*(\d+\.?\d*)\s*%', r'(\1 * (1 + \2 / 100))', expression)
-        expression = re.sub(r'(\(?\d[\d\.\s]*\)?)\s*-\s*(\d+\.?\d*)\s*%', r'(\1 * (1 - \2 / 100))', expression)
+# --- Логика вычислений ---
 
-        safe_pattern = re.compile(r'^[ \d\.\+\-\*\/\(\)]+$')
-        if not safe_pattern.match(expression):
-            return "Ошибка: недопустимые символы"
+def _tokenize(expression: str) -> list[tuple[str, object]]:
+    """
+    Разбивает выражение на токены ("num", float), ("pct", float) и ("op", str).
+    Для "+X%" и "-X%" сразу вычисляется множитель 1 ± X/100.
+    """
+    # Быстрый отсев посторонних символов одним проходом translate, до запуска токенизатора
+    if expression.translate(_DROP_EXPRESSION_CHARS):
+        raise ValueError("недопустимые символы")
+
+    tokens = []
+    pos = 0
+    length = len(expression)
+    while pos < length:
+        match = _TOKEN_RE.match(expression, pos)
+        if not match:
+            if expression[pos:].strip():
+                raise ValueError(f"недопустимый символ в позиции {pos}")
+            break
+        if match.group('pct') is not None:
+            percent = float(match.group('pct')) / 100
+            factor = 1 + percent if match.group('pct_sign') == '+' else 1 - percent
+            tokens.append(("pct", factor))
+        elif match.group('num') is not None:
+            tokens.append(("num", float(match.group('num'))))
+        else:
+            tokens.append(("op", match.group('op')))
+        pos = match.end()
+    return tokens
 
-        result = eval(expression, {"__builtins__": {}}, {})
 
+def _eval_arith(expression: str) -> float:
+    """
+    Вычисляет арифметическое выражение во float без eval().
+    Decimal используется только для итогового округления в evaluate_expression.
+
+    Грамматика (по убыванию приоритета):
+        atom    := число | "(" expr ")"
+        postfix := atom ("+X%" | "-X%")*     -- процент от непосредственно стоящего слева операнда
+        power   := postfix ("**" unary)?
+        unary   := ("+" | "-") unary | power
+        term    := unary (("*" | "/" | "//") unary)*
+        expr    := term (("+" | "-") term)*
+    """
+    tokens = _tokenize(expression)
+    pos = 0
+    depth = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else (None, None)
+
+    def take():
+        nonlocal pos
+        if pos >= len(tokens):
+            raise SyntaxError("неожиданный конец выражения")
+        pos += 1
+        return tokens[pos - 1]
+
+    def atom() -> float:
+        kind, value = take()
+        if kind == "num":
+            return value
+        if (kind, value) == ("op", "("):
+            nonlocal depth
+            depth += 1
+            if depth > _MAX_PAREN_DEPTH:
+                raise SyntaxError("слишком глубокая вложенность скобок")
+            result = expr()
+            if take() != ("op", ")"):
+                raise SyntaxError("ожидалась закрывающая скобка")
+            depth -= 1
+            return result
+        raise SyntaxError(f"неожиданный токен {value!r}")
+
+    def postfix() -> float:
+        result = atom()
+        while peek()[0] == "pct":
+            result *= take()[1]
+        return result
+
+    def power() -> float:
+        result = postfix()
+        if peek() == ("op", "**"):
+            take()
+            result = result ** unary()
+        return result
+
+    def unary() -> float:
+        if peek() == ("op", "-"):
+            take()
+            return -unary()
+        if peek() == ("op", "+"):
+            take()
+            return unary()
+        return power()
+
+    def term() -> float:
+        result = unary()
+        while peek()[0] == "op" and peek()[1] in ("*", "/", "//"):
+            op = take()[1]
+            rhs = unary()
+            if op == "*":
+                result *= rhs
+            elif op == "/":
+                result /= rhs
+            else:
+                result //= rhs
+        return result
+
+    def expr() -> float:
+        result = term()
+        while peek()[0] == "op" and peek()[1] in ("+", "-"):
+            op = take()[1]
+            rhs = term()
+            result = result + rhs if op == "+" else result - rhs
+        return result
+
+    if not tokens:
+        raise SyntaxError("пустое выражение")
+    result = expr()
+    if pos != len(tokens):
+        raise SyntaxError(f"лишний токен {tokens[pos][1]!r}")
+    return result
+
+
+_FIAT_QUANTUM = Decimal('0.01')
+_CRYPTO_QUANTUM = Decimal('0.00000001')
+
+
+async def evaluate_expression(expression: str) -> str:
+    original_expression = expression
+    try:
+        # Курсы нужны только если в выражении есть тикеры; чистая арифметика обходится без сети
+        needed = set(_TICKER_RE.findall(expression))
+        if needed:
+            prices = await fetch_all_prices(needed)
+            if not needed <= prices.keys():
+                return "Ошибка: не удалось загрузить курсы."
+
+            # Все тикеры заменяются за один проход
+            price_strs = _price_strings()
+            expression = _TICKER_RE.sub(lambda m: price_strs[m.group(1)], expression)
+
+        result = _eval_arith(expression)
+        # Float не выбрасывает исключений при переполнении: вместо этого получаются inf и nan.
+        # Комплексный результат (например, (-8)**(1/3)) тоже не показываем
+        if not isinstance(result, float) or not math.isfinite(result):
+            return "Ошибка в вычислениях"
+
+        # Переход в Decimal только здесь, для точного округления и форматирования
         if any(crypto in original_expression for crypto in ['bnc', 'eth', 'ob', 'oe']):
-            result = round(Decimal(result), 8)
+            result = Decimal(repr(result)).quantize(_CRYPTO_QUANTUM)
         else:
-            result = round(Decimal(result), 2)
+            result = Decimal(repr(result)).quantize(_FIAT_QUANTUM)
+        # Float дает отрицательный ноль (-0, 0*-5), показываем его как 0
+        if not result:
+            result = abs(result)
 
-        return f'{result:,}'.replace(',', ' ').replace('.', ',')
+        return f'{result:,f}'.replace(',', ' ').replace('.', ',')
 
-    except (SyntaxError, NameError):
+    except (SyntaxError, RecursionError):
         return "Ошибка в синтаксисе"
+    except ValueError:
+        return "Ошибка: недопустимые символы"
     except ZeroDivisionError:
         return "Ошибка: деление на ноль"
-    except (InvalidOperation, TypeError):
+    except (InvalidOperation, OverflowError, TypeError):
         return "Ошибка в вычислениях"
     except Exception as e:
         logging.error(f"Ошибка при вычислении '{original_expression}': {e}")
         return "Неизвестная ошибка"
 
 
-# --- Обработчики команд ---
+# --- Тексты сообщений ---
+# Имя бота не меняется во время работы, поэтому тексты собираются один раз при запуске
 
-async def send_start_and_help(message: Message):
-    """Отправляет приветствие и справку на русском языке."""
-    bot_user = await message.bot.get_me()
-    bot_name = bot_user.username
-    help_text = f"""
+_HELP_RU_TEMPLATE = """
 <b>🧮 Калькулятор в инлайн-режиме</b>
 
 Начните печатать в любом чате имя бота (<code>@{bot_name}</code>), а затем математическое выражение. Результат появится во всплывающем окне.
@@ -224,14 +658,8 @@ async def send_start_and_help(message: Message):
 
 Для получения этой справки на английском, используйте /help_en
     """
-    await message.answer(text=help_text, parse_mode=ParseMode.HTML)
-
 
-async def send_help_en(message: Message):
-    """Отправляет справку на английском языке."""
-    bot_user = await message.bot.get_me()
-    bot_name = bot_user.username
-    help_text = f"""
+_HELP_EN_TEMPLATE = """
 <b>🧮 Inline Mode Calculator</b>
 
 Start typing the bot's username (<code>@{bot_name}</code>) in any chat, followed by a mathematical expression. The result will appear in a pop-up window.
@@ -255,7 +683,36 @@ Start typing the bot's username (<code>@{bot_name}</code>) in any chat, followed
 
 To get this help in Russian, use /help
     """
-    await message.answer(text=help_text, parse_mode=ParseMode.HTML)
+
+_INLINE_HINT_TEMPLATE = (
+    "Я работаю в инлайн-режиме.\n\n"
+    "Просто начните печатать <code>@{bot_name}</code> и ваше выражение в любом чате.\n"
+    "Для получения подробной инструкции, отправьте команду /help."
+)
+
+HELP_RU = ""
+HELP_EN = ""
+INLINE_HINT = ""
+
+
+def build_texts(bot_name: str):
+    """Подставляет имя бота в тексты справки и подсказки."""
+    global HELP_RU, HELP_EN, INLINE_HINT
+    HELP_RU = _HELP_RU_TEMPLATE.format(bot_name=bot_name)
+    HELP_EN = _HELP_EN_TEMPLATE.format(bot_name=bot_name)
+    INLINE_HINT = _INLINE_HINT_TEMPLATE.format(bot_name=bot_name)
+
+
+# --- Обработчики команд ---
+
+async def send_start_and_help(message: Message):
+    """Отправляет приветствие и справку на русском языке."""
+    await message.answer(text=HELP_RU, parse_mode=ParseMode.HTML)
+
+
+async def send_help_en(message: Message):
+    """Отправляет справку на английском языке."""
+    await message.answer(text=HELP_EN, parse_mode=ParseMode.HTML)
 
 
 async def send_stats(message: Message):
@@ -263,21 +720,15 @@ async def send_stats(message: Message):
         await message.answer("У вас нет прав для выполнения этой команды.")
         return
 
-    stats = load_stats()
-    now = datetime.now(UTC)
+    stats = STATS
+    today = _day_key(int(time.time()))
 
-    dau = 0
-    mau = 0
-    if 'users' in stats:
-        for last_seen_iso in stats['users'].values():
-            last_seen = datetime.fromisoformat(last_seen_iso).astimezone(UTC)
-            if now - last_seen <= timedelta(days=1):
-                dau += 1
-            if now - last_seen <= timedelta(days=30):
-                mau += 1
+    # Оба показателя поддерживаются инкрементально, без прохода по всем пользователям
+    dau = stats.get('daily_users', {}).get(today, 0)
+    mau = len(stats.get('users', {}))
 
     total_req = stats.get('total_requests', 0)
-    today_req = stats.get('daily_requests', {}).get(now.strftime('%Y-%m-%d'), 0)
+    today_req = stats.get('daily_requests', {}).get(today, 0)
 
     stats_text = f"""
 <b>📊 Статистика бота</b>
@@ -293,18 +744,16 @@ async def send_stats(message: Message):
 
 async def handle_other_messages(message: Message):
     """Обрабатывает любые текстовые сообщения, не являющиеся командами."""
-    bot_user = await message.bot.get_me()
-    bot_name = bot_user.username
-    await message.answer(
-        f"Я работаю в инлайн-режиме.\n\n"
-        f"Просто начните печатать <code>@{bot_name}</code> и ваше выражение в любом чате.\n"
-        f"Для получения подробной инструкции, отправьте команду /help.",
-        parse_mode=ParseMode.HTML
-    )
+    await message.answer(INLINE_HINT, parse_mode=ParseMode.HTML)
 
 
 # --- Обработчик инлайн-запросов ---
 
+# Для HTML нужно экранировать только <, > и &
+_HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+INLINE_RESULT_DESCRIPTION = "Нажмите, чтобы отправить результат расчета."
+
+
 async def inline_handler(query: InlineQuery, bot: Bot):
     user_query = query.query.lower().strip()
     if not user_query:
@@ -314,20 +763,20 @@ async def inline_handler(query: InlineQuery, bot: Bot):
 
     result_text = await evaluate_expression(user_query)
 
-    # Для HTML нужно экранировать только <, > и &
-    escaped_query = html.escape(query.query)
-    escaped_result = html.escape(result_text)
+    # Результат формирует сам бот (число или текст ошибки), экранировать нужно только запрос
+    escaped_query = query.query.translate(_HTML_ESCAPE_TABLE)
 
-    message_content = f"<code>{escaped_query}</code> = <b>{escaped_result}</b>"
+    message_content = f"<code>{escaped_query}</code> = <b>{result_text}</b>"
 
-    result_article = InlineQueryResultArticle(
+    # Все поля формирует сам бот, поэтому pydantic-валидацию можно пропустить (model_construct)
+    result_article = InlineQueryResultArticle.model_construct(
         id='1',
         title=f"Результат: {result_text}",
-        input_message_content=InputTextMessageContent(
+        input_message_content=InputTextMessageContent.model_construct(
             message_text=message_content,
             parse_mode=ParseMode.HTML
         ),
-        description="Нажмите, чтобы отправить результат расчета."
+        description=INLINE_RESULT_DESCRIPTION
     )
 
     await query.answer([result_article], cache_time=30, is_personal=True)
@@ -336,6 +785,7 @@ async def inline_handler(query: InlineQuery, bot: Bot):
 # --- Главная функция для запуска бота ---
 
 async def main():
+    global SESSION
     bot = Bot(token=BOT_TOKEN)
     dp = Dispatcher()
 
@@ -350,12 +800,48 @@ async def main():
 
     await bot.delete_webhook(drop_pending_updates=True)
 
-    logging.info("Бот запущен и готов к работе...")
-    await dp.start_polling(bot)
+    bot_user = await bot.get_me()
+    build_texts(bot_user.username)
+
+    STATS.update(await asyncio.to_thread(load_stats))
+    evict_inactive_users()
+    stop_flusher = asyncio.Event()
+    flusher = asyncio.create_task(flush_stats_periodically(stop_flusher))
+
+    SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=32,
+            limit_per_host=8,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,
+            keepalive_timeout=75,
+        ),
+        timeout=HTTP_TIMEOUT,
+    )
+    try:
+        logging.info("Бот запущен и готов к работе...")
+        await dp.start_polling(bot)
+    finally:
+        # Фоновая задача сама сохранит то, что не успела записать; дожидаемся ее, а не отменяем,
+        # чтобы две записи файла не шли одновременно
+        stop_flusher.set()
+        try:
+            await flusher
+        finally:
+            await SESSION.close()
 
 
 if __name__ == '__main__':
+    # uvloop заметно быстрее стандартного цикла событий, но недоступен на Windows
+    try:
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        logging.info("uvloop не установлен, используется стандартный цикл событий asyncio.")
+        loop_factory = None
+
     try:
-        asyncio.run(main())
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
         logging.info("Бот остановлен.")
\ No newline at end of file